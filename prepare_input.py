@@ -1,5 +1,9 @@
 import requests
 import json
+import os
+import gzip
+import hashlib
+import re
 import bibtexparser
 import xmltodict
 import copy
@@ -15,6 +19,8 @@ locale.setlocale(locale.LC_COLLATE, "hr_HR.UTF-8")
 # Known journals
 journals = cfg.journals
 issn     = cfg.issn
+# Journals resolved via Inspire HEP and stored in a local cache file
+journal_cache = {}
 # --------------------------------------------------
 
 
@@ -77,6 +83,8 @@ def get_volume(name, volume):
 
 def get_journal(name):
     if name not in journals.keys():
+        if name in journal_cache.keys():
+            return journal_cache[name]['journal']
         return None
 
     return journals[name]
@@ -84,12 +92,216 @@ def get_journal(name):
 
 def get_issn(name):
     if name not in issn.keys():
+        if name in journal_cache.keys():
+            return journal_cache[name]['issn']
         return ['', '']
 
     return issn[name]
 
 
-def prepare_input(list_of_papers, output_file, configuration, exclusion_list):
+def load_journal_cache(cache_file):
+    if not os.path.isfile(cache_file):
+        return {}
+
+    with open(cache_file, encoding='utf8') as f:
+        try:
+            cache = json.load(f)
+        except ValueError as e:
+            print('\nWARNING: Journal cache file {} could not be read ({}). Starting with an empty cache.'.format(cache_file, e))
+            return {}
+
+    if not isinstance(cache, dict):
+        print('\nWARNING: Journal cache file {} could not be read (unexpected format). Starting with an empty cache.'.format(cache_file))
+        return {}
+
+    # Drop any malformed entries
+    for name in list(cache.keys()):
+        entry = cache[name]
+        if (isinstance(entry, dict) and isinstance(entry.get('journal'), str) and
+            isinstance(entry.get('issn'), list) and len(entry['issn']) == 2):
+            continue
+        print('\nWARNING: Journal cache file {} could not be read for journal {} (unexpected format). Dropping the entry.'.format(cache_file, name))
+        del cache[name]
+
+    return cache
+
+
+def save_journal_cache(cache_file):
+    with open(cache_file, 'w', encoding='utf8') as outfile:
+        json.dump(journal_cache, outfile, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+def normalize_journal_name(name):
+    # Inspire HEP stores short titles without spaces (e.g. 'Phys.Rev.D') while
+    # BibTeX exports use spaced ones (e.g. 'Phys. Rev. D'). Title variants are
+    # mostly uppercase and without dots
+    return ''.join(name.split()).replace('.', '').lower()
+
+
+def resolve_journals(names, batch_size=20):
+    # Look up journals by name in the Inspire HEP journals database. Names are
+    # matched against the short title, the full title and the title variants
+    # More info at: https://github.com/inspirehep/rest-api-doc
+    resolved = {}
+    names = sorted(names)
+
+    for i in range(0, len(names), batch_size):
+        batch = names[i:i+batch_size]
+        # Search for both the original and the unspaced names (the form used for short titles)
+        search_names = []
+        for n in batch:
+            for v in [n, ''.join(n.split())]:
+                if v not in search_names:
+                    search_names.append(v)
+        # Escape backslashes and double quotes so that names can be used inside quoted phrases
+        escaped = [n.replace('\\', '\\\\').replace('"', '\\"') for n in search_names]
+        query = ' or '.join(['short_title:"{0}" or journal_title.title:"{0}" or title_variants:"{0}"'.format(n) for n in escaped])
+        params = {
+            'q': query,
+            'size': 10*len(batch),
+            'fields': 'short_title,journal_title,title_variants,issns'
+        }
+        try:
+            hits = requests.get('https://inspirehep.net/api/journals', params=params).json()['hits']['hits']
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print('\nWARNING: Journal lookup on Inspire HEP failed ({}).'.format(e))
+            continue
+
+        for h in hits:
+            metadata = h['metadata']
+            short_title = metadata.get('short_title', '')
+            full_title = metadata.get('journal_title', {}).get('title', '')
+            titles = [short_title, full_title] + metadata.get('title_variants', [])
+            titles_normalized = [normalize_journal_name(t) for t in titles if t]
+
+            # ISSNs
+            _issn = ['', '']
+            other_issns = []
+            for i_data in metadata.get('issns', []):
+                medium = i_data.get('medium', '')
+                if medium == 'print' and not _issn[0]:
+                    _issn[0] = i_data['value']
+                elif medium in ['online', 'electronic'] and not _issn[1]:
+                    _issn[1] = i_data['value']
+                elif medium not in ['print', 'online', 'electronic'] and 'value' in i_data:
+                    other_issns.append(i_data['value'])
+            # Fall back to ISSNs with no (or an unexpected) medium
+            for idx in range(2):
+                if not _issn[idx] and len(other_issns) > 0:
+                    _issn[idx] = other_issns.pop(0)
+            # Journals without any ISSN are left unresolved
+            if _issn == ['', '']:
+                continue
+
+            for n in batch:
+                if n in resolved or normalize_journal_name(n) not in titles_normalized:
+                    continue
+                resolved[n] = {
+                    'journal': (full_title if full_title else short_title),
+                    'issn': list(_issn)
+                }
+
+    return resolved
+
+
+def open_output(filename, compression=None):
+    if compression == 'gzip':
+        return gzip.open(filename, 'wt', encoding='utf8')
+    if compression == 'zstd':
+        # Optional dependency, only needed for zstd-compressed output
+        import zstandard
+        return zstandard.open(filename, 'wt', encoding='utf8')
+
+    return open(filename, 'w', encoding='utf8')
+
+
+def get_checksum(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+
+def write_chunks(data, output_file, max_records=None, max_bytes=None, compression=None):
+    # Split records into numbered chunk files, each one a valid CROSBI API JSON
+    # array. Records are serialized and written one at a time. Chunk sizes are
+    # capped by the number of records and/or the uncompressed size in bytes
+    base, ext = os.path.splitext(output_file)
+    suffix = {'gzip': '.gz', 'zstd': '.zst'}.get(compression, '')
+    manifest_file = base + '_manifest.json'
+
+    # Chunk files written by the previous run
+    previous_chunk_files = []
+    if os.path.isfile(manifest_file):
+        try:
+            with open(manifest_file, encoding='utf8') as f:
+                previous_chunk_files = [c['file'] for c in json.load(f)['chunks']]
+        except (ValueError, KeyError, TypeError) as e:
+            print('\nWARNING: Previous manifest file {} could not be read ({}). Stale chunk files will not be removed.'.format(manifest_file, e))
+
+    manifest = {'chunks': []}
+    outfile = None
+    filename = ''
+    chunk_dois = []
+    chunk_bytes = 0
+
+    def close_chunk():
+        outfile.write('\n]\n')
+        outfile.close()
+        manifest['chunks'].append({
+            'file': os.path.basename(filename),
+            'records': len(chunk_dois),
+            'sha256': get_checksum(filename),
+            'dois': chunk_dois
+        })
+        print('Chunk {}: {} paper(s) written to {}'.format(len(manifest['chunks']), len(chunk_dois), filename))
+
+    for record in data:
+        record_string = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+        # Record plus the separating comma and newline (the last record only has a newline
+        # but the chunk also ends with a closing bracket and a newline)
+        record_bytes = len(record_string.encode('utf8')) + 2
+        if max_bytes and (3 + record_bytes) > max_bytes:
+            print('\nWARNING: Paper with DOI:{} exceeds the maximum chunk size on its own and will be written to a separate chunk.'.format(record['doi']))
+        # Start a new chunk if needed
+        if outfile is not None and ((max_records and len(chunk_dois) >= max_records) or
+                                    (max_bytes and (chunk_bytes + record_bytes) > max_bytes)):
+            close_chunk()
+            outfile = None
+        if outfile is None:
+            filename = '{}_{:03d}{}{}'.format(base, len(manifest['chunks'])+1, ext, suffix)
+            outfile = open_output(filename, compression)
+            outfile.write('[\n')
+            chunk_dois = []
+            chunk_bytes = 3 # opening and closing brackets and newlines, minus the last record's comma
+        else:
+            outfile.write(',\n')
+        outfile.write(record_string)
+        chunk_dois.append(record['doi'])
+        chunk_bytes += record_bytes
+    if outfile is not None:
+        close_chunk()
+
+    # Remove chunk files left over from the previous run
+    chunk_files = [c['file'] for c in manifest['chunks']]
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    stale_pattern = re.compile(r'^{}_\d{{3,}}{}(\.gz|\.zst)?$'.format(re.escape(os.path.basename(base)), re.escape(ext)))
+    for f in previous_chunk_files:
+        stale_file = os.path.join(output_dir, f)
+        if stale_pattern.match(f) and f not in chunk_files and os.path.isfile(stale_file):
+            os.remove(stale_file)
+            print('Removed stale chunk file {}'.format(stale_file))
+
+    # Manifest
+    with open(manifest_file, 'w', encoding='utf8') as outfile:
+        json.dump(manifest, outfile, ensure_ascii=False, indent=2)
+    print('Manifest written to {}'.format(manifest_file))
+
+
+def prepare_input(list_of_papers, output_file, configuration, exclusion_list, journal_cache_file=None, journal_lookup=True,
+                  max_records=None, max_bytes=None, compression=None):
     # --------------------------------------------------
     # Configuration
     collaboration = cfg.cfg_sets[configuration]['collaboration']
@@ -110,6 +322,32 @@ def prepare_input(list_of_papers, output_file, configuration, exclusion_list):
     noAuthor = []
     invalidPage = []
 
+    # Resolve all unknown journals in one go before processing papers
+    if journal_cache_file:
+        journal_cache.update(load_journal_cache(journal_cache_file))
+    if journal_lookup:
+        unresolved = set()
+        seen_dois = set()
+        for p in list_of_papers.entries:
+            # Skip excluded and duplicate DOIs as well as entries without journal info
+            doi_lower = p.get('doi', '').lower()
+            if doi_lower in exclusion_list or doi_lower in seen_dois:
+                continue
+            seen_dois.add(doi_lower)
+            if 'journal' not in p or 'volume' not in p:
+                continue
+            journal_name = get_name(p['journal'], p['volume'])
+            if get_journal(journal_name) is None:
+                unresolved.add(journal_name)
+        if len(unresolved) > 0:
+            print('Looking up %i unknown journal(s) on Inspire HEP...' % len(unresolved))
+            resolved = resolve_journals(unresolved)
+            for j in sorted(resolved):
+                print('  {} -> {} (ISSN: {}, e-ISSN: {})'.format(j, resolved[j]['journal'], resolved[j]['issn'][0], resolved[j]['issn'][1]))
+            journal_cache.update(resolved)
+            if journal_cache_file and len(resolved) > 0:
+                save_journal_cache(journal_cache_file)
+
     # Loop over all papers which are stored in bib
     for n, p in enumerate(list_of_papers.entries, 1):
 
@@ -492,10 +730,15 @@ def prepare_input(list_of_papers, output_file, configuration, exclusion_list):
         print('\n%i paper(s) from the following unknown journal(s):\n' % unknown_counter)
         for j in sorted(unknownJournals):
             print(j)
+        if journal_lookup:
+            print('\nThe above journal(s) could not be resolved on Inspire HEP.')
         print('\nPlease add the unknown journal info to configuration.py\n')
 
-    # Output file, i.e. input for CroRIS
-    if len(data) > 0:
+    # Output file(s), i.e. input for CroRIS
+    # In chunked mode the manifest is always rewritten so that chunks from a previous run are not reused
+    if max_records or max_bytes or compression:
+        write_chunks(data, output_file, max_records, max_bytes, compression)
+    elif len(data) > 0:
         with open(output_file, 'w', encoding='utf8') as outfile:
             json.dump(data, outfile, ensure_ascii=False, indent=2)
 
@@ -527,8 +770,43 @@ if __name__ == '__main__':
                       help="Text file containing a list of DOIs to exclude (one per line)",
                       metavar="EXCLUDE")
 
+    parser.add_argument("-j", "--journal-cache", dest="journal_cache",
+                      help="JSON file used to cache journal info resolved via Inspire HEP (default: %(default)s)",
+                      metavar="JOURNAL_CACHE",
+                      default="journal_cache.json")
+
+    parser.add_argument("--no-journal-lookup", dest="no_journal_lookup",
+                      help="Do not look up unknown journals on Inspire HEP",
+                      action="store_true",
+                      default=False)
+
+    parser.add_argument("--max-records", dest="max_records",
+                      help="Split the output into numbered chunk files with at most this many papers each",
+                      metavar="MAX_RECORDS",
+                      type=int)
+
+    parser.add_argument("--max-bytes", dest="max_bytes",
+                      help="Split the output into numbered chunk files with at most this many (uncompressed) bytes each",
+                      metavar="MAX_BYTES",
+                      type=int)
+
+    parser.add_argument("--compress", dest="compress",
+                      help="Compress the output chunk files. Options: gzip, zstd (requires the zstandard package)",
+                      metavar="COMPRESS",
+                      choices=['gzip', 'zstd'])
+
     (options, args) = parser.parse_known_args()
 
+    if options.max_records is not None and options.max_records < 1:
+        parser.error('--max-records must be at least 1')
+    if options.max_bytes is not None and options.max_bytes < 1:
+        parser.error('--max-bytes must be at least 1')
+    if options.compress == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            parser.error('zstd compression requires the zstandard package (pip install zstandard)')
+
     # Load list of papers from a BibTeX file
     list_of_papers = get_list_of_papers(options.input)
 
@@ -538,4 +816,6 @@ if __name__ == '__main__':
         exclusion_list = get_exclusion_list(options.exclude)
 
     # Create input for CroRIS
-    prepare_input(list_of_papers, options.output, options.configuration.lower(), exclusion_list)
+    prepare_input(list_of_papers, options.output, options.configuration.lower(), exclusion_list,
+                  options.journal_cache, not options.no_journal_lookup,
+                  options.max_records, options.max_bytes, options.compress)